@@ -4,18 +4,44 @@ import time
 import sys
 import os
 import math
-from enum import Enum
+import queue
+import threading
+import re
+import copy
+from array import array
+from collections import OrderedDict, deque
+from functools import lru_cache
+from itertools import chain, groupby
+from operator import add
+from enum import IntEnum
 import yaml
+try:
+    from yaml import CSafeLoader as _Loader # libyaml C bindings, much faster
+except ImportError:
+    from yaml import SafeLoader as _Loader # Pure-Python fallback
 
 # --- Configuration Loading ---
-def load_config():
-    """Loads configuration from config.yaml"""
-    config_path = os.path.join(os.path.dirname(__file__), 'config.yaml')
+_YAML_CACHE = OrderedDict() # path -> (mtime, size, parsed data), oldest first
+_YAML_CACHE_MAX = 100
+
+def load_config(config_path=None):
+    """Loads configuration from config.yaml (cached by file mtime and size)"""
+    if config_path is None:
+        config_path = os.path.join(os.path.dirname(__file__), 'config.yaml')
     try:
+        st = os.stat(config_path)
+        cached = _YAML_CACHE.get(config_path)
+        if cached and cached[0] == st.st_mtime and cached[1] == st.st_size:
+            _YAML_CACHE.move_to_end(config_path)
+            return copy.deepcopy(cached[2]) # Unchanged file, skip re-parsing
         with open(config_path, 'r') as f:
-            config_data = yaml.safe_load(f)
+            config_data = yaml.load(f, Loader=_Loader)
             print(f"Successfully loaded configuration from {config_path}")
-            return config_data
+        _YAML_CACHE[config_path] = (st.st_mtime, st.st_size, config_data)
+        _YAML_CACHE.move_to_end(config_path)
+        if len(_YAML_CACHE) > _YAML_CACHE_MAX:
+            _YAML_CACHE.popitem(last=False) # Evict least recently used entry
+        return copy.deepcopy(config_data)
     except FileNotFoundError:
         print(f"Error: Configuration file not found at {config_path}")
         sys.exit(1)
@@ -50,106 +76,67 @@ PEN_UP_HEIGHT = config['text_gcode']['pen_up_height']
 PEN_DOWN_DEPTH = config['text_gcode']['pen_down_depth'] # Might not be directly used with M3/M5
 FEED_RATE_Z = config['text_gcode']['feed_rate_z'] # Might not be directly used with M3/M5
 
+# --- Fixed Constants (not read from config) ---
+LINE_CHANGE_DWELL = 19.0 # Seconds GRBL dwells after the line-return move, before M04 (change line)
+M04_DWELL = 1.1 # Seconds GRBL dwells between M04 and the following M05
+LINE_RETURN_FEED_RATE = 1500 # mm/min of the G0 line-return move, also used for the ack timeout estimate
+GRBL_REINIT_INTERVAL = 30 # Minimum seconds between reconnection attempts from process_text
+
 # --- Global Variables ---
 ser = None # Serial object for GRBL communication, initialized globally
+_last_init_ts = 0.0 # time.time() of the last init_grbl() attempt
 letters = {} # Dictionary to store loaded letter G-code definitions
+_job_q = queue.Queue(maxsize=32) # Decoded MQTT payloads waiting for the G-code worker thread
 
 # --- Text to G-code Classes and Functions (Adapted from https://github.com/Stypox/text-to-gcode) ---
-class Instr:
-    class Type(Enum):
-        move = 0,
-        write = 1,
-
-    def __init__(self, *args):
-        if len(args) == 1 and type(args[0]) is str: # args must be a data str (a line from .nc file)
-            line = args[0].strip() # Remove leading/trailing whitespace
-            if not line or line.startswith('(') or line.startswith('%'): # Skip empty lines or common comment/control lines
-                # Raise a specific exception or set a flag to indicate this line should be skipped
-                raise ValueError("Skipping invalid or comment line") 
-
-            attributes = line.split(' ')
-            # G_ X__ Y__ --- Add robust checks
-            try:
-                # Check if enough parts and if G-code part is long enough
-                if len(attributes) >= 3 and len(attributes[0]) >= 2 and attributes[0][0] == 'G':
-                    # Check if the type character is '0' or '1' (or others if needed)
-                    if attributes[0][1] == '0':
-                        self.type = Instr.Type.move
-                    elif attributes[0][1] == '1':
-                        self.type = Instr.Type.write
-                    else:
-                         raise ValueError("Unsupported G command type in line") # Skip if not G0 or G1
-
-                    # Check if X and Y parts are long enough and start with X/Y
-                    if len(attributes[1]) > 1 and attributes[1][0] == 'X' and \
-                       len(attributes[2]) > 1 and attributes[2][0] == 'Y':
-                        self.x = float(attributes[1][1:])
-                        self.y = float(attributes[2][1:])
-                    else:
-                        raise ValueError("Invalid X/Y format in line") # Skip if X/Y format wrong
-                else:
-                    raise ValueError("Line does not match expected G# X# Y# format") # Skip if basic structure wrong
-            except (ValueError, IndexError) as e:
-                 # If any check fails or conversion error occurs, raise to signal skipping
-                 # Use ValueError for semantic issues, IndexError might occur if split result is too short
-                 # Re-raise or wrap the exception to be caught in Letter.__init__
-                 raise ValueError(f"Skipping line due to parsing error: {e} - Line: '{line}'")
-
-        elif len(args) == 3 and type(args[0]) is Instr.Type and type(args[1]) is float and type(args[2]) is float:
-            self.type, self.x, self.y = args
-        else:
-            raise TypeError("Instr() takes one (str) or three (Instr.Type, float, float) arguments")
+# 'G# X# Y#' lines of a .nc file; accepts G0/G00/G1/G01 and any float() style number (X.5, X+1, X1.)
+_GLINE_RE = re.compile(r'^[ \t]*G0?([01])[ \t]+X([-+]?(?:\d+\.?\d*|\.\d+))[ \t]+Y([-+]?(?:\d+\.?\d*|\.\d+))', re.MULTILINE)
 
-    def __repr__(self):
-        # Use .value[0] to get the first value of the enum (i.e., integer 0 or 1)
-        return "G%d X%.2f Y%.2f" % (self.type.value[0], self.x, self.y)
-
-    def translated(self, x, y):
-        return Instr(self.type, self.x + x, self.y + y)
+class Instr:
+    # Only the instruction type enum remains; Letter stores instructions as arrays
+    class Type(IntEnum):
+        move = 0
+        write = 1
 
 class Letter:
-    def __init__(self, *args):
-        if len(args) == 1 and type(args[0]) is str:
-            self.instructions = []
-            skipped_lines = 0 # Counter for skipped lines
-            for line in args[0].split('\n'):
-                line = line.strip() # Ensure stripped line is used
-                if line != "":
-                    try:
-                        # Attempt to create Instr, might raise ValueError if line should be skipped
-                        self.instructions.append(Instr(line)) 
-                    except ValueError as e:
-                         # Catch the specific error raised by Instr.__init__ for skippable lines
-                         # print(f"Debug: Skipping line in Letter init: {e}") # Optional: Debug print
-                         skipped_lines += 1 
-                         
-            # Optional: Print how many lines were skipped for this letter if needed for debugging
-            # if skipped_lines > 0:
-            #    print(f"Debug: Skipped {skipped_lines} lines while parsing letter data.")
-
-            pointsOnX = [instr.x for instr in self.instructions if hasattr(instr, 'x')] # Safety check
-            if pointsOnX:
-                # Add check for min/max on empty list
-                self.width = max(pointsOnX) - min(pointsOnX) if pointsOnX else 0.0
+    # Instructions are stored as parallel arrays (types, xs, ys), types holding Instr.Type values
+    def __init__(self, types, xs, ys, width=None):
+        if width is None: # Derive the glyph width from its X extent
+            width = max(xs) - min(xs) if xs else 0.0
+        self.types, self.xs, self.ys, self.width = types, xs, ys, width
+        self.xys = tuple(chain.from_iterable(zip(xs, ys))) # Interleaved X/Y, in template placeholder order
+
+        # G-code for the whole glyph as one %-format string with X/Y placeholders, built once at load time.
+        # The pen only toggles at boundaries between runs of consecutive G0/G1 instructions.
+        template_lines = []
+        for run_type, group in groupby(self.types):
+            count = len(list(group))
+            if run_type == Instr.Type.write:
+                template_lines.append("M03 S150") # Pen Down before G1
+                template_lines.extend(["G1 F1500.0 X%.2f Y%.2f"] * count)
+                template_lines.append("M05 F1500.0") # Pen Up before next G0 or after last instruction
             else:
-                self.width = 0.0 
-
-        elif len(args) == 2 and type(args[0]) is list and type(args[1]) is float:
-            self.instructions = args[0]
-            self.width = args[1]
-        else:
-            raise TypeError("Letter() takes one (str) or two (list, float) arguments")
+                template_lines.extend(["G0 F1500.0 X%.2f Y%.2f"] * count)
+        self.template = "\n".join(template_lines)
+
+    @classmethod
+    def from_text(cls, text):
+        """Builds a Letter from the contents of a .nc file, matching all G0/G1 lines in one pass.
+        Comment, control and malformed lines simply do not match and are skipped."""
+        matches = _GLINE_RE.findall(text) # [(g, x, y), ...] as strings
+        gs, xs, ys = zip(*matches) if matches else ((), (), ())
+        types = array('B', map(int, gs))
+        xs = array('d', map(float, xs))
+        ys = array('d', map(float, ys))
+        return cls(types, xs, ys)
 
     def __repr__(self):
-        return "\n".join([repr(instr) for instr in self.instructions]) + "\n"
-
-    def translated(self, x, y):
-        return Letter([instr.translated(x, y) for instr in self.instructions], self.width)
+        return "\n".join(["G%d X%.2f Y%.2f" % instr for instr in zip(self.types, self.xs, self.ys)]) + "\n"
 
 def readLetters(directory):
     local_letters = {
-        " ": Letter([], 4.0), # Space definition width
-        "\n": Letter([], math.inf) # Newline character handling
+        " ": Letter(array('B'), array('d'), array('d'), 4.0), # Space definition width
+        "\n": Letter(array('B'), array('d'), array('d'), math.inf) # Newline character handling
     }
     print(f"Reading letter definitions from: {directory}")
     if not os.path.isdir(directory):
@@ -167,13 +154,16 @@ def readLetters(directory):
                         # Handle potential single character filenames vs multi-character like 'exclamation'
                         # For simplicity, we use the base filename directly.
                         
+                        if os.path.getsize(filepath) == 0: # Only add if file is not empty
+                            print(f"Warning: Skipping empty file {filename}")
+                            continue
                         with open(filepath, "r", encoding='utf-8') as file: # Specify encoding
-                            data = file.read()
-                            if data: # Only add if file is not empty
-                                local_letters[char_key] = Letter(data)
-                                print(f"  Successfully loaded character: '{char_key}' from {filename}") 
-                            else:
-                                print(f"Warning: Skipping empty file {filename}")
+                            letter = Letter.from_text(file.read())
+                        local_letters[char_key] = letter
+                        if letter.types:
+                            print(f"  Successfully loaded character: '{char_key}' from {filename}") 
+                        else:
+                            print(f"Warning: No G0/G1 X Y lines found in {filename}, character '{char_key}' will draw nothing")
                     except UnicodeDecodeError:
                         print(f"Error reading file {filename}: 'utf-8' codec can't decode byte, skipping file")
                     except Exception as e:
@@ -189,8 +179,9 @@ def readLetters(directory):
     return local_letters
 
 def textToGcode(text, letters, line_length, line_spacing, padding):
-    """Converts a string of text into G-code lines using preloaded letter definitions."""
+    """Converts a string of text into a newline-separated G-code block using preloaded letter definitions."""
     output = []
+    append = output.append # Bound once, used for every emitted line
     current_x = 0
     current_y = 0
     FEED_RATE_XY = 300 # Default Feed rate for drawing movements (X, Y) -> Will be removed from output
@@ -201,7 +192,7 @@ def textToGcode(text, letters, line_length, line_spacing, padding):
     
     lines = text.split('\n')
     first_line = True
-    pen_is_down = False # New state variable to track pen state
+    # The pen is always up between characters: every letter template ends with M05 after its last G1
 
     for line_text in lines:
         if not first_line:
@@ -209,71 +200,58 @@ def textToGcode(text, letters, line_length, line_spacing, padding):
             print(line_text)
             current_y -= line_spacing
             current_x = 0
-            # Pen up before moving to the start of the new line
-            if pen_is_down:
-                output.append("M05") # Pen Up before new line
-                pen_is_down = False
-            output.append(f"G0 F1500 X{current_x:.2f} Y{current_y:.2f}") # Move to start of new line
-            output.append("M04")
-            output.append("M05")
+            append(f"G0 F{LINE_RETURN_FEED_RATE} X{current_x:.2f} Y{current_y:.2f}") # Move to start of new line
+            # G4 dwells are planner-synchronized: they start once the line-return move has finished
+            append(f"G4 P{LINE_CHANGE_DWELL:.1f}")
+            append("M04")
+            append(f"G4 P{M04_DWELL:.1f}")
+            append("M05")
         else:
             first_line = False
 
         for char in line_text:
-            if char in letters:
-                letter_data = letters[char]
-                if not letter_data.instructions:
-                    # Handle space or characters with no drawing instructions (just advance X)
-                    current_x += letter_data.width + padding
-                    # Ensure pen is up before moving to the next character's potential start
-                    if pen_is_down:
-                        output.append("M05")
-                        pen_is_down = False
-                    # We might still need a G0 move here if only width is defined? Assume no for now.
-                    continue # Move to the next character
-
-                # Pen down/up logic is now handled inside the loop based on instruction type
-                # output.append("M03") # Removed initial M03 before loop
-                pen_is_down = False # Reset pen state for each letter initially? No, let it carry over? Let's reset. Assume start with pen up.
-
-                # Apply offset to letter instructions
-                for instr in letter_data.instructions:
-                    # Calculate absolute coordinates based on current position
-                    x = current_x + instr.x
-                    y = current_y + instr.y
-                    
-                    if instr.type == Instr.Type.move: # G0 Move
-                        if pen_is_down:
-                            output.append("M05 F1500.0") # Pen Up before G0
-                            pen_is_down = False
-                        output.append(f"G0 F1500.0 X{x:.2f} Y{y:.2f}")
-
-                    elif instr.type == Instr.Type.write: # G1 Move
-                        if not pen_is_down:
-                            output.append("M03 S150") # Pen Down before G1
-                            pen_is_down = True
-                        output.append(f"G1 F1500.0 X{x:.2f} Y{y:.2f}") # New G1 without Feed Rate
-
-                # Pen up after finishing all instructions for the character
-                if pen_is_down:
-                    output.append("M05 F1500.0") # Ensure Pen Up after last instruction
-                    pen_is_down = False
-                    
-                # Update current_x for the next character
-                current_x += letter_data.width + padding
-                # Move G0 to the starting X of the next char - Pen should be up already
-                output.append(f"G0 F1000.0 X{current_x:.2f} Y{current_y:.2f}")
-
-            else:
+            letter_data = letters.get(char) # Single lookup instead of "in" + []
+            if letter_data is None:
                 print(f"Warning: Character '{char}' not found in definitions. Skipping.")
                 # Optionally advance X by a default width or space width?
                 # current_x += letters.get(' ', {'width': default_space_width})['width'] + padding 
+                continue
+
+            if not letter_data.types:
+                # Handle space or characters with no drawing instructions (just advance X)
+                current_x += letter_data.width + padding
+                # We might still need a G0 move here if only width is defined? Assume no for now.
+                continue # Move to the next character
+
+            # Pen down/up logic is baked into the letter template based on instruction type
+            # Apply offset to letter instructions; map/add and tuple repetition keep the per-point work in C
+            coords = tuple(map(add, letter_data.xys, (current_x, current_y) * len(letter_data.types)))
+            append(letter_data.template % coords) # Whole glyph as one multi-line chunk
+
+            # Update current_x for the next character
+            current_x += letter_data.width + padding
+            # Move G0 to the starting X of the next char - Pen should be up already
+            append(f"G0 F1000.0 X{current_x:.2f} Y{current_y:.2f}")
     
     # Final pen up (just in case)
     # output.append(f"G0 Z{PEN_UP_HEIGHT:.2f}") # Original Final Pen Up
     # We already added M05 after the last character or line break handling.
 
-    return output
+    return '\n'.join(output)
+
+@lru_cache(maxsize=256)
+def _textToGcode_cached(text):
+    """textToGcode for the global letters, memoized per text (repeated MQTT payloads skip conversion).
+    Call cache_clear() if letters is reloaded."""
+    return textToGcode(text, letters, LINE_LENGTH, LINE_SPACING, PADDING)
+
+def gcode_ack_timeout(text, letters, line_spacing, padding, margin=10.0):
+    """Worst-case seconds to wait for a single GRBL ack while streaming the G-code of text.
+    GRBL holds back the ok of M03/M05/G4 until all queued motion is done, so this covers the longest
+    line-return move plus the line-change dwells, with a margin for the moves still in the planner."""
+    widest = max(sum(letters[char].width + padding for char in line_text if char in letters) for line_text in text.split('\n'))
+    line_return_time = (widest + line_spacing) / (LINE_RETURN_FEED_RATE / 60.0)
+    return line_return_time + LINE_CHANGE_DWELL + M04_DWELL + margin
 
 # --- End Text to G-code --- 
 
@@ -289,10 +267,7 @@ def send_gcode(command, timeout=2.0):
     if ser and ser.is_open:
         try:
             print(f"[GCODE->GRBL] {command}")
-            if command == 'M04': #change line
-                time.sleep(19)
             ser.write((command + '\n').encode('utf-8'))
-            ser.flush()
             start_time = time.time()
             response_buffer = b''
             while True:
@@ -301,7 +276,6 @@ def send_gcode(command, timeout=2.0):
                     response_buffer += line
                     decoded_line = line.decode('utf-8', errors='ignore').strip()
                     print(f"[GRBL<-] {decoded_line}")
-                    time.sleep(1.1)
                     if decoded_line == 'ok' or decoded_line.startswith('error:'):
                         return decoded_line == 'ok', decoded_line
                 if time.time() - start_time > timeout:
@@ -315,14 +289,136 @@ def send_gcode(command, timeout=2.0):
         print(command) # 串口不可用时降级为打印
         return True, "Printed_to_console"
 
+def close_grbl_for_reconnect():
+    """Closes the GRBL serial port so the next job reconnects and re-initializes GRBL, without waiting for the rate limit."""
+    global ser, _last_init_ts
+    if ser and ser.is_open:
+        ser.close()
+        print("GRBL serial port closed.")
+    ser = None
+    _last_init_ts = 0.0
+
+def send_gcode_block(block, timeout=2.0):
+    """
+    使用GRBL字符计数协议发送一整段G-code（多行，以\n分隔）：整段只编码一次，在GRBL接收缓冲区(GRBL_BUFFER_SIZE)
+    允许的范围内把尽可能多的行合并为一次写入，并按顺序读取每行的ok/error回应。如果串口不可用，则打印G-code。
+    :param block: 要发送的G-code字符串（多行）
+    :param timeout: 等待单个GRBL回应的超时时间（秒）
+    :return: (success:bool, response:str)
+    """
+    global ser
+    if not (ser and ser.is_open):
+        print(block) # 串口不可用时降级为打印
+        return True, "Printed_to_console"
+
+    data = (block + '\n').encode('utf-8')
+    in_flight = deque() # 已排队但尚未收到回应的各行字节数
+    buffered = 0 # GRBL接收缓冲区中的字节数
+
+    def wait_for_ack():
+        # Returns (True, 'ok'), (False, 'error:..') or (None, received text) on timeout
+        nonlocal buffered
+        start_time = time.time()
+        response_buffer = b''
+        while True:
+            line = ser.readline() # 读到\n为止
+            if line:
+                response_buffer += line
+                decoded_line = line.decode('utf-8', errors='ignore').strip()
+                print(f"[GRBL<-] {decoded_line}")
+                if decoded_line == 'ok' or decoded_line.startswith('error:'):
+                    buffered -= in_flight.popleft()
+                    return decoded_line == 'ok', decoded_line
+            if time.time() - start_time > timeout:
+                final_response = response_buffer.decode('utf-8', errors='ignore').strip()
+                print(f"[GRBL TIMEOUT] {final_response}")
+                return None, final_response
+
+    def write_chunk(chunk):
+        print(f"[GCODE->GRBL] {chunk.decode('utf-8').rstrip()}")
+        ser.write(chunk)
+
+    def abort(response):
+        # GRBL reported an error: the lines already written are still queued in its RX buffer and would
+        # keep executing. Soft-reset GRBL to discard them; their acks will never come.
+        print(f"[GRBL] Aborting message with soft reset, {len(in_flight)} queued line(s) discarded")
+        in_flight.clear()
+        ser.write(b'\x18') # Ctrl-X soft reset
+        # Read the restart banner. A reset during motion leaves GRBL in ALARM, where every line fails with error:9.
+        alarm = False
+        banner_seen = False
+        start_time = time.time()
+        while time.time() - start_time < 2.0:
+            line = ser.readline()
+            if not line:
+                if banner_seen:
+                    break # Banner and any following [MSG:...] lines have been read
+                continue
+            decoded_line = line.decode('utf-8', errors='ignore').strip()
+            print(f"[GRBL<-] {decoded_line}")
+            if decoded_line.startswith('ALARM') or 'to unlock' in decoded_line:
+                alarm = True
+            elif decoded_line.startswith('Grbl'):
+                banner_seen = True
+        if alarm or not banner_seen:
+            print("GRBL is in ALARM state or did not restart after the reset. The next message will reconnect and re-initialize it.")
+            close_grbl_for_reconnect()
+        return False, response
+
+    def stop(response):
+        # An ack timed out, which may just be a long synchronized move: write no more lines, but wait for
+        # the acks of the queued ones so the next command is not acknowledged by a stale ok.
+        print(f"[GRBL] Stopping message, waiting for {len(in_flight)} queued line(s) to be acknowledged")
+        while in_flight:
+            success, _ = wait_for_ack()
+            if success is None:
+                print("GRBL is not responding. The next message will reconnect and re-initialize it.")
+                close_grbl_for_reconnect()
+                break
+        return False, response
+
+    try:
+        written = 0 # Bytes of data already written to the serial port
+        start = 0
+        while start < len(data):
+            end = data.index(b'\n', start) + 1
+            length = end - start
+            if in_flight and buffered + length > GRBL_BUFFER_SIZE:
+                # The next line does not fit: send the queued lines in one write, then wait for room
+                if written < start:
+                    write_chunk(data[written:start])
+                    written = start
+                while in_flight and buffered + length > GRBL_BUFFER_SIZE:
+                    success, response = wait_for_ack()
+                    if success is None:
+                        return stop(response)
+                    if not success:
+                        return abort(response)
+            in_flight.append(length)
+            buffered += length
+            start = end
+        if written < len(data):
+            write_chunk(data[written:])
+        while in_flight: # Drain the remaining acknowledgements
+            success, response = wait_for_ack()
+            if success is None:
+                return stop(response)
+            if not success:
+                return abort(response)
+        return True, "ok"
+    except Exception as e:
+        print(f"[GCODE ERROR] 发送到串口失败: {e}")
+        return False, str(e)
+
 # --- GRBL Initialization --- # (Modified to not actually connect)
 def init_grbl():
     """Initializes the serial connection to the GRBL controller and sends initial commands."""
-    global ser
+    global ser, _last_init_ts
     if SERIAL_PORT is None:
         print("SERIAL_PORT not set. Running in GRBL communication bypass mode.")
         return True # Allow running without GRBL connection
 
+    _last_init_ts = time.time()
     try:
         print(f"Attempting to connect to GRBL on {SERIAL_PORT} at {BAUD_RATE} baud...")
         ser = serial.Serial(SERIAL_PORT, BAUD_RATE, timeout=0.1) # Short timeout for initial handshake
@@ -406,7 +502,6 @@ def on_disconnect(client, userdata, flags, reason_code, properties):
     # Note: loop_forever() handles reconnections automatically by default
 
 def on_message(client, userdata, msg):
-    global ser, letters # Ensure using global letters
     print(f"\n--- MQTT Message Received ---")
     print(f"Topic: {msg.topic}")
     print(f"Raw Payload: {msg.payload}")
@@ -417,16 +512,35 @@ def on_message(client, userdata, msg):
         print("Error: Could not decode payload as UTF-8.")
         print("--- End MQTT Message Processing ---")
         return
-        
+
+    # Conversion and serial streaming run on the worker thread so the MQTT network loop is never blocked
+    try:
+        _job_q.put_nowait(text_payload)
+        print(f"Message queued for G-code processing ({_job_q.qsize()} pending).")
+    except queue.Full:
+        print(f"Error: G-code job queue is full ({_job_q.maxsize} messages pending). Dropping this message.")
+    print("--- End MQTT Message Processing ---")
+
+def process_text(text_payload):
+    """Converts one decoded MQTT text payload to G-code and sends it to GRBL (runs on the worker thread)."""
+    global ser, letters # Ensure using global letters
+    print(f"\n--- G-code Job Started: {text_payload!r} ---")
+
     # Log the state of 'ser' before checking the connection
     print(f"Checking Serial Port: ser={'Exists' if ser else 'None'}, is_open={ser.is_open if ser else 'N/A'}")
 
     # Check GRBL connection before proceeding
     if not (ser and ser.is_open):
-        print("GRBL serial port not available or not open. Attempting to reconnect...")
-        if not init_grbl():
-             print("Failed to reconnect to GRBL. Skipping message processing for this message.")
-             return # Exit if re-init fails (though it shouldn't in bypass mode)
+        if SERIAL_PORT is not None and time.time() - _last_init_ts < GRBL_REINIT_INTERVAL:
+            # Do not fall through to bypass mode: the message would only be printed but reported as done
+            print(f"GRBL serial port not available. Last reconnection attempt was less than {GRBL_REINIT_INTERVAL}s ago, not retrying yet. Skipping this message.")
+            print("--- End G-code Job ---")
+            return
+        else:
+            print("GRBL serial port not available or not open. Attempting to reconnect...")
+            if not init_grbl():
+                print("Failed to reconnect to GRBL. Skipping message processing for this message.")
+                return # Exit if re-init fails (though it shouldn't in bypass mode)
 
     if not letters: # Check if letters dictionary is populated
         print("Error: Letter definitions are not loaded. Cannot convert text to G-code. Skipping message.")
@@ -434,27 +548,21 @@ def on_message(client, userdata, msg):
 
     # Convert received text to G-code
     print("Converting text to G-code...")
-    gcode_output = textToGcode(text_payload, letters, LINE_LENGTH, LINE_SPACING, PADDING)
+    gcode_output = _textToGcode_cached(text_payload)
 
     if not gcode_output:
         print("G-code conversion resulted in empty output. Skipping sending.")
-        print("--- End MQTT Message Processing ---")
+        print("--- End G-code Job ---")
         return
 
-    # Send G-code line by line
-    gcode_lines = gcode_output
-    print(f"Processing {len(gcode_lines)} G-code line(s) generated from text:")
-    # print(gcode_lines) # Uncomment to see the generated G-code list
+    # Stream the whole G-code block using GRBL's character-counting protocol
+    line_count = gcode_output.count('\n') + 1
+    print(f"Processing {line_count} G-code line(s) generated from text:")
+    # print(gcode_output) # Uncomment to see the generated G-code
     
-    success = True
-    for line in gcode_lines:
-        line = line.strip()
-        if line: # Ignore empty lines
-            success, response = send_gcode(line) # Get tuple (success_flag, message)
-            if not success:
-                print(f"Failed to execute G-code: {line}. Stopping further execution for this message. Response: {response}")
-                # success = False # Already set implicitly by send_gcode return
-                break # If one line fails, stop sending the rest for this message
+    success, response = send_gcode_block(gcode_output, timeout=gcode_ack_timeout(text_payload, letters, LINE_SPACING, PADDING))
+    if not success:
+        print(f"Failed to stream G-code. Stopping further execution for this message. Response: {response}")
     if success:
         print("Finished processing G-code from message.")
         # --- Send Post-Message G-code (Conditional) --- 
@@ -471,12 +579,24 @@ def on_message(client, userdata, msg):
         else:
             print("Skipping post-message G-code (input ended with newline).")
             
-    print("--- End MQTT Message Processing ---")
+    print("--- End G-code Job ---")
+
+def gcode_worker():
+    """Consumes queued text payloads one at a time, so G-code is streamed to GRBL in message order."""
+    while True:
+        text_payload = _job_q.get()
+        try:
+            process_text(text_payload)
+        except Exception as e:
+            print(f"An unexpected error occurred while processing a G-code job: {e}")
+        finally:
+            _job_q.task_done()
 
 # Main Program
 if __name__ == "__main__":
     # Load letter definitions
     letters = readLetters(GCODE_DIR)
+    _textToGcode_cached.cache_clear() # Cached G-code depends on the loaded letters
     if letters is None: # Check for None instead of not letters
         print("Failed to load letter definitions or directory not found. Exiting.")
         sys.exit(1)
@@ -503,6 +623,9 @@ if __name__ == "__main__":
     client.on_disconnect = on_disconnect
     client.on_message = on_message
 
+    # Start the worker that converts and streams queued messages
+    threading.Thread(target=gcode_worker, name="gcode-worker", daemon=True).start()
+
     # Set username and password (usually not required for public brokers)
     # if MQTT_USERNAME and MQTT_PASSWORD:
     #     client.username_pw_set(MQTT_USERNAME, MQTT_PASSWORD)